@@ -13,6 +13,7 @@ from logging.handlers import TimedRotatingFileHandler
 import csv
 import json
 import re
+import fnmatch
 import urllib.request
 import boto3
 from dateutil.relativedelta import relativedelta
@@ -28,6 +29,10 @@ PATTERN = re.compile("20[0-9]{2}-[0-9]{1,2}-[0-9]{1,2}")
 TWOMONTHSPLUSCURRENT = ((datetime.date.today() - relativedelta(months=2)).replace(day=1) - datetime.timedelta(days=1))
 THIRTYDAYS = (datetime.date.today() - datetime.timedelta(days=30))
 TODAY = datetime.date.today()
+RETENTION_PERIODS = ('2MonthsPlusCurrent', '30Days', '30DaysDropOnly', 'PartitionMaxDate')
+MANIFEST_COLUMNS = ('database_name', 'table_name', 's3_location',
+                    'retention_period', 'days_to_keep', 'partitioned_by')
+SIZE_PARAMETERS = ('sizeKey', 'totalSize')
 LOG_FILE = "/APP/athena-partition.log"
 
 """
@@ -539,32 +544,309 @@ def partition_max_date(database_name, table_name, s3_location, retention, partit
         send_message_to_slack(err)
         error_handler(sys.exc_info()[2].tb_lineno, err)
 
-def check_table(database_name, table_name):
+def name_matcher(pattern):
     """
-    Checks for the existence of a table in the Glue catalogue.
+    Compiles a database_name / table_name value from the manifest into a matcher.
+    Values prefixed with "re:" are regular expressions that must match the whole
+    name, values containing any of "*?[" are globs, anything else is a literal.
+    Matching ignores case, as Glue stores names in lower case.
 
     Args:
-        database_name  : the schema name in Athena
-        table_name     : the table name in Athena
+        pattern        : the value from the manifest
     Returns:
+        A function taking a name and returning True if it matches,
+        or None if the value is a literal name
+    """
 
-        Glue response in JSON format
+    if pattern.startswith('re:'):
+        return re.compile(pattern[3:], re.IGNORECASE).fullmatch
+    if any(char in pattern for char in '*?['):
+        return lambda name: fnmatch.fnmatchcase(name.lower(), pattern.lower())
+    return None
+
+
+def rule_retention(retention_period, days_to_keep):
+    """
+    Works out the retention cutoff for a manifest rule, once per rule rather
+    than once per table.
+
+    Args:
+        retention_period : one of RETENTION_PERIODS
+        days_to_keep     : number of days to keep (PartitionMaxDate only)
+    Returns:
+        The cutoff date as a string, or None if the rule should not run today
+    """
+
+    if retention_period == '2MonthsPlusCurrent':
+        if TODAY != TODAY.replace(day=1):
+            return None
+        return str(TWOMONTHSPLUSCURRENT)
+    if retention_period == 'PartitionMaxDate':
+        return str(TODAY - datetime.timedelta(days=int(days_to_keep)))
+    return str(THIRTYDAYS)
+
+
+def load_manifest(manifest_file):
+    """
+    Reads and validates the manifest CSV, reporting every bad row at once
+    before any table is touched.
+
+    Args:
+        manifest_file  : path to the downloaded CSV
+    Returns:
+        A list of rules in manifest order
+    """
+
+    with open(manifest_file) as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        missing = [col for col in MANIFEST_COLUMNS if col not in (csv_reader.fieldnames or [])]
+        if missing:
+            raise ValueError('Manifest is missing required column(s): ' + ', '.join(missing))
+
+        rules = []
+        errors = []
+        for line_no, row in enumerate(csv_reader, start=2):
+            row = {col: (row[col] or '').strip() for col in MANIFEST_COLUMNS}
+            if not row['database_name'] or not row['table_name']:
+                errors.append('line {0}: database_name and table_name are required'.format(line_no))
+                continue
+            if row['retention_period'] not in RETENTION_PERIODS:
+                errors.append('line {0}: unknown retention_period "{1}"'.format(
+                    line_no, row['retention_period']))
+                continue
+            if row['retention_period'] == 'PartitionMaxDate':
+                if not row['days_to_keep'].isdecimal():
+                    errors.append('line {0}: days_to_keep must be a whole number of days'.format(line_no))
+                    continue
+                if not row['partitioned_by']:
+                    errors.append('line {0}: partitioned_by is required'.format(line_no))
+                    continue
+            try:
+                database_match = name_matcher(row['database_name'])
+                table_match = name_matcher(row['table_name'])
+            except re.error as err:
+                errors.append('line {0}: invalid regular expression: {1}'.format(line_no, err))
+                continue
+
+            if not database_match:
+                row['database_name'] = row['database_name'].lower()
+            if not table_match:
+                row['table_name'] = row['table_name'].lower()
+            row['line'] = line_no
+            row['database_match'] = database_match
+            row['table_match'] = table_match
+            row['retention'] = rule_retention(row['retention_period'], row['days_to_keep'])
+            rules.append(row)
+
+    if errors:
+        raise ValueError('Invalid manifest:\n' + '\n'.join(errors))
+
+    LOGGER.info('Loaded %s rule(s) from the manifest', len(rules))
+    return rules
+
+
+def table_size(table):
+    """
+    Best effort size in bytes of a Glue table, taken from the parameters the
+    crawler or Athena leave on the table. Used only to order the execution plan.
+    Falls back to recordCount x averageRecordSize, and to 0 when neither is set,
+    so those tables sort last in manifest order.
+
+    Args:
+        table          : a Table from glue's get_tables API
+    Returns:
+        The size in bytes as an int, 0 if unknown
+    """
+
+    for params in (table.get('Parameters', {}),
+                   table.get('StorageDescriptor', {}).get('Parameters', {})):
+        for key in SIZE_PARAMETERS:
+            try:
+                return int(params[key])
+            except (KeyError, ValueError):
+                continue
+        try:
+            return int(params['recordCount']) * int(params['averageRecordSize'])
+        except (KeyError, ValueError):
+            continue
+    LOGGER.debug('No size recorded for %s, it will be processed last.', table['Name'])
+    return 0
+
+
+def list_databases():
+    """
+    Lists every database in the Glue catalogue.
+
+    Returns:
+        A list of database names
+    """
+
+    paginator = GLUE.get_paginator('get_databases')
+    return [database['Name'] for page in paginator.paginate() for database in page['DatabaseList']]
+
+
+def list_tables(database_name):
+    """
+    Lists every table in a database with one paginated get_tables call.
+
+    Args:
+        database_name  : the schema name in Athena
+    Returns:
+        A dict of table name to table size, or None if the database does not exist
     """
 
     try:
-        response = GLUE.get_table(
-            DatabaseName=database_name,
-            Name=table_name
-        )
-        return response
+        paginator = GLUE.get_paginator('get_tables')
+        return {table['Name']: table_size(table)
+                for page in paginator.paginate(DatabaseName=database_name)
+                for table in page['TableList']}
     except ClientError as err:
-        if err.response['Error']['Code'] in 'EntityNotFoundException':
-            err = 'Table ' + database_name + '.' + table_name + ' not found!'
+        if err.response['Error']['Code'] == 'EntityNotFoundException':
+            err = 'Database ' + database_name + ' not found!'
             send_message_to_slack(err)
             LOGGER.warning(err)
+            return None
+        raise err
+
+
+def compile_manifest(rules):
+    """
+    Expands the manifest rules against the Glue catalogue into an execution plan.
+    Each database is listed once, however many rules refer to it. Where more than
+    one rule matches a table, the first rule in the manifest wins. Missing tables
+    are only reported to Slack for literal rows, tables a wildcard matches without
+    an _archive table are logged and skipped.
+
+    Args:
+        rules          : the rules returned by load_manifest
+    Returns:
+        A list of tables to process, largest first
+    """
+
+    catalogue = {}
+    databases = None
+    claimed = set()
+    plan = []
+
+    for rule in rules:
+        if rule['database_match']:
+            if databases is None:
+                databases = list_databases()
+            database_names = [name for name in databases if rule['database_match'](name)]
         else:
-            send_message_to_slack(err)
-            error_handler(sys.exc_info()[2].tb_lineno, err)
+            database_names = [rule['database_name']]
+
+        matched = 0
+        unarchived = []
+        for database_name in database_names:
+            if database_name not in catalogue:
+                catalogue[database_name] = list_tables(database_name)
+            tables = catalogue[database_name]
+            if tables is None:
+                continue
+
+            if rule['table_match']:
+                table_names = sorted(name for name in tables
+                                     if not name.endswith('_archive') and rule['table_match'](name))
+            elif rule['table_name'] in tables:
+                table_names = [rule['table_name']]
+            else:
+                table_names = []
+                if not rule['database_match']:
+                    err = 'Table ' + database_name + '.' + rule['table_name'] + ' not found!'
+                    send_message_to_slack(err)
+                    LOGGER.warning(err)
+
+            for table_name in table_names:
+                matched += 1
+                if (database_name, table_name) in claimed:
+                    LOGGER.debug('%s.%s already planned by an earlier rule, ignoring line %s.',
+                                 database_name, table_name, rule['line'])
+                    continue
+                claimed.add((database_name, table_name))
+
+                if table_name + '_archive' not in tables:
+                    if rule['database_match'] or rule['table_match']:
+                        LOGGER.debug('Table %s.%s_archive not found, skipping.', database_name, table_name)
+                        unarchived.append(database_name + '.' + table_name)
+                    else:
+                        err = 'Table ' + database_name + '.' + table_name + '_archive not found!'
+                        send_message_to_slack(err)
+                        LOGGER.warning(err)
+                    continue
+                if rule['retention'] is None:
+                    LOGGER.info('Ignoring %s.%s until the 1st of the month.', database_name, table_name)
+                    continue
+
+                plan.append({
+                    'database_name': database_name,
+                    'table_name': table_name,
+                    's3_location': rule['s3_location'],
+                    'retention_period': rule['retention_period'],
+                    'retention': rule['retention'],
+                    'partitioned_by': rule['partitioned_by'],
+                    'size': tables[table_name],
+                    })
+
+        if not matched and (rule['database_match'] or rule['table_match']):
+            LOGGER.warning('Line %s (%s.%s) did not match any tables.',
+                           rule['line'], rule['database_name'], rule['table_name'])
+        if unarchived:
+            LOGGER.info('Line %s (%s.%s) skipped %s table(s) without an _archive table.',
+                        rule['line'], rule['database_name'], rule['table_name'], len(unarchived))
+
+    # sort is stable, so tables without a known size keep their manifest order at the end
+    plan.sort(key=lambda item: item['size'], reverse=True)
+    LOGGER.info('Execution plan has %s table(s) across %s database(s).', len(plan), len(catalogue))
+    return plan
+
+
+def archive_partitions(database_name, table_name, retention, drop_only):
+    """
+    Moves partitions older than the retention date to the _archive table using
+    the glue API's, or just drops them if drop_only is set.
+
+    Args:
+        database_name  : the schema name in Athena
+        table_name     : the table name in Athena
+        retention      : date beyond which older partitions will be dropped
+        drop_only      : drop the partitions without archiving them
+    Returns:
+        None
+    """
+
+    for parts in get_partitions(database_name, table_name, retention):
+        if not drop_only:
+            create_partition(parts, database_name, f'{table_name}_archive')
+        for desc in parts:
+            del desc['StorageDescriptor']
+        execute_glue_api_delete(database_name, table_name, parts)
+
+
+def execute_plan(plan):
+    """
+    Runs each table in the execution plan against its retention period.
+
+    Args:
+        plan           : the plan returned by compile_manifest
+    Returns:
+        None
+    """
+
+    for item in plan:
+        database_name = item['database_name']
+        table_name = item['table_name']
+        retention = item['retention']
+
+        if item['retention_period'] == 'PartitionMaxDate':
+            partition_max_date(database_name, table_name,
+                               item['s3_location'], retention, item['partitioned_by'])
+        else:
+            LOGGER.info('Processing %s.%s, removing partitions older than %s.',
+                        database_name, table_name, retention)
+            archive_partitions(database_name, table_name, retention,
+                               item['retention_period'] == '30DaysDropOnly')
+
 
 def main():
     """
@@ -597,58 +879,10 @@ def main():
         send_message_to_slack(err)
         error_handler(sys.exc_info()[2].tb_lineno, err)
 
-    drop_only = False
-
     try:
-        with open("/APP/list.csv") as csv_file:
-            csv_reader = csv.DictReader(csv_file)
-
-            for row in csv_reader:
-                database_name = row["database_name"]
-                table_name = row["table_name"]
-                s3_location = row["s3_location"]
-                retention_period = row["retention_period"]
-
-                origin_table = check_table(database_name, table_name)
-                if origin_table:
-
-                    archive_table = check_table(database_name, table_name + "_archive")
-                    if archive_table:
-
-                        if retention_period == '2MonthsPlusCurrent':
-                            if TODAY != TODAY.replace(day=1):
-                                LOGGER.info('Ignoring %s.%s until the 1st of the month.', database_name, table_name)
-                            else:
-                                retention = str(TWOMONTHSPLUSCURRENT)
-                                #partition(database_name, table_name, s3_location, retention, drop_only)
-                                for parts in get_partitions(database_name, table_name, retention):
-                                    create_partition(parts, database_name, f'{table_name}_archive')
-                                    for desc in parts:
-                                        del desc['StorageDescriptor']
-                                    execute_glue_api_delete(database_name, table_name, parts)
-                        elif retention_period == '30Days':
-                            retention = str(THIRTYDAYS)
-                            #partition(database_name, table_name, s3_location, retention, drop_only)
-                            for parts in get_partitions(database_name, table_name, retention):
-                                create_partition(parts, database_name, f'{table_name}_archive')
-                                for desc in parts:
-                                    del desc['StorageDescriptor']
-                                execute_glue_api_delete(database_name, table_name, parts)
-                        elif retention_period == '30DaysDropOnly':
-                            retention = str(THIRTYDAYS)
-                            #drop_only = True
-                            #partition(database_name, table_name, s3_location, retention, drop_only)
-                            for parts in get_partitions(database_name, table_name, retention):
-                                for desc in parts:
-                                    del desc['StorageDescriptor']
-                                execute_glue_api_delete(database_name, table_name, parts)
-                        elif retention_period == 'PartitionMaxDate':
-                            days_to_keep = row["days_to_keep"]
-                            retention = (datetime.date.today() - datetime.timedelta(days=int(days_to_keep)))
-                            partitioned_by = row["partitioned_by"]
-                            partition_max_date(database_name, table_name,
-                                               s3_location, retention, partitioned_by)
-
+        rules = load_manifest("/APP/list.csv")
+        plan = compile_manifest(rules)
+        execute_plan(plan)
 
         LOGGER.info("We are done here.")
 
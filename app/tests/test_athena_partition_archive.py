@@ -0,0 +1,181 @@
+"""
+Tests for the manifest compiler in athena_partition_archive
+"""
+
+
+import os
+import sys
+import logging
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault('ATHENA_LOG', 's3-athena-log')
+os.environ.setdefault('CSV_S3_BUCKET', 's3-bucket-csv')
+os.environ.setdefault('CSV_S3_FILE', 'list.csv')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+# The script logs to /APP on import, which only exists in the container
+with mock.patch('logging.handlers.TimedRotatingFileHandler',
+                side_effect=lambda *args, **kwargs: logging.NullHandler()):
+    import athena_partition_archive as archive
+
+HEADER = 'database_name,table_name,s3_location,retention_period,days_to_keep,partitioned_by\n'
+
+
+class StubPaginator:
+    """
+    Stands in for a Glue paginator, serving one table per page
+    """
+
+    def __init__(self, operation, catalogue):
+        self.operation = operation
+        self.catalogue = catalogue
+
+    def paginate(self, **kwargs):
+        if self.operation == 'get_databases':
+            yield {'DatabaseList': [{'Name': name} for name in self.catalogue]}
+            return
+        for table in self.catalogue[kwargs['DatabaseName']]:
+            yield {'TableList': [table]}
+
+
+class StubGlue:
+    """
+    Stands in for the Glue client
+    """
+
+    def __init__(self, catalogue):
+        self.catalogue = catalogue
+
+    def get_paginator(self, operation):
+        return StubPaginator(operation, self.catalogue)
+
+
+def table(name, **params):
+    return {'Name': name, 'Parameters': params}
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.slack = mock.patch.object(archive, 'send_message_to_slack').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def write_manifest(self, rows, header=HEADER):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write(header + rows)
+        self.addCleanup(os.remove, csv_file.name)
+        return csv_file.name
+
+    def compile(self, rows, catalogue):
+        mock.patch.object(archive, 'GLUE', StubGlue(catalogue)).start()
+        return archive.compile_manifest(archive.load_manifest(self.write_manifest(rows)))
+
+
+class TestNameMatcher(unittest.TestCase):
+
+    def test_literal(self):
+        self.assertIsNone(archive.name_matcher('table1'))
+
+    def test_glob(self):
+        match = archive.name_matcher('fms_*')
+        self.assertTrue(match('fms_events'))
+        self.assertFalse(match('api_events'))
+
+    def test_regex_matches_whole_name(self):
+        match = archive.name_matcher('re:fms_[0-9]+')
+        self.assertTrue(match('fms_1'))
+        self.assertFalse(match('fms_1_old'))
+
+    def test_ignores_case(self):
+        self.assertTrue(archive.name_matcher('FMS_*')('fms_events'))
+        self.assertTrue(archive.name_matcher('re:FMS_.*')('fms_events'))
+
+
+class TestLoadManifest(ManifestTestCase):
+
+    def test_missing_column(self):
+        path = self.write_manifest('', header='database_name,table_name,s3_location,retention_period\n')
+        with self.assertRaisesRegex(ValueError, 'days_to_keep, partitioned_by'):
+            archive.load_manifest(path)
+
+    def test_reports_every_invalid_line(self):
+        path = self.write_manifest(
+            'db1,t1,b/p,Forever,,\n'
+            'db1,t2,b/p,PartitionMaxDate,seven,date_local\n'
+            'db1,t3,b/p,PartitionMaxDate,7,\n'
+            'db1,re:(,b/p,30Days,,\n'
+            'db1,t4,b/p,PartitionMaxDate,\u00b2,date_local\n')
+        with self.assertRaises(ValueError) as ctx:
+            archive.load_manifest(path)
+        message = str(ctx.exception)
+        self.assertIn('line 2: unknown retention_period "Forever"', message)
+        self.assertIn('line 3: days_to_keep', message)
+        self.assertIn('line 4: partitioned_by', message)
+        self.assertIn('line 5: invalid regular expression', message)
+        self.assertIn('line 6: days_to_keep', message)
+
+    def test_retention_computed_per_rule(self):
+        rules = archive.load_manifest(self.write_manifest(
+            'DB1,Table1,b/p,PartitionMaxDate,7,date_local\n'
+            'db1,t2,b/p,30Days,,\n'))
+        self.assertEqual(rules[0]['retention'], str(archive.TODAY - archive.datetime.timedelta(days=7)))
+        self.assertEqual(rules[1]['retention'], str(archive.THIRTYDAYS))
+        self.assertEqual((rules[0]['database_name'], rules[0]['table_name']), ('db1', 'table1'))
+
+
+class TestCompileManifest(ManifestTestCase):
+
+    def test_specific_line_wins_over_wildcard(self):
+        plan = self.compile(
+            'db1,t1,b/p,PartitionMaxDate,7,date_local\n'
+            'db1,*,b/p,30Days,,\n',
+            {'db1': [table('t1'), table('t1_archive'), table('t2'), table('t2_archive')]})
+        periods = {item['table_name']: item['retention_period'] for item in plan}
+        self.assertEqual(periods, {'t1': 'PartitionMaxDate', 't2': '30Days'})
+
+    def test_wildcard_excludes_archive_tables(self):
+        plan = self.compile(
+            'db1,*,b/p,30Days,,\n',
+            {'db1': [table('t1'), table('t1_archive'), table('t2')]})
+        self.assertEqual([item['table_name'] for item in plan], ['t1'])
+        self.slack.assert_not_called()
+
+    def test_literal_row_without_archive_alerts(self):
+        plan = self.compile('db1,t2,b/p,30Days,,\n', {'db1': [table('t2')]})
+        self.assertEqual(plan, [])
+        self.slack.assert_called_once_with('Table db1.t2_archive not found!')
+
+    def test_literal_names_ignore_case(self):
+        plan = self.compile('DB1,Table1,b/p,30Days,,\n',
+                            {'db1': [table('table1'), table('table1_archive')]})
+        self.assertEqual([item['table_name'] for item in plan], ['table1'])
+
+    def test_missing_database_alerts_once(self):
+        error = archive.ClientError({'Error': {'Code': 'EntityNotFoundException'}}, 'GetTables')
+        glue = mock.Mock()
+        glue.get_paginator.return_value.paginate.side_effect = error
+        mock.patch.object(archive, 'GLUE', glue).start()
+        rules = archive.load_manifest(self.write_manifest(
+            'db1,t1,b/p,30Days,,\n'
+            'db1,t2,b/p,30Days,,\n'))
+        self.assertEqual(archive.compile_manifest(rules), [])
+        self.slack.assert_called_once_with('Database db1 not found!')
+
+    def test_ordered_by_bytes_largest_first(self):
+        plan = self.compile(
+            'db1,*,b/p,30Days,,\n',
+            {'db1': [table('rows_only', recordCount='5000000'), table('rows_only_archive'),
+                     table('unknown_a'), table('unknown_a_archive'),
+                     table('small', sizeKey='100000'), table('small_archive'),
+                     table('estimated', recordCount='1000', averageRecordSize='500'),
+                     table('estimated_archive'),
+                     table('unknown_b'), table('unknown_b_archive')]})
+        self.assertEqual([item['table_name'] for item in plan],
+                         ['estimated', 'small', 'rows_only', 'unknown_a', 'unknown_b'])
+
+
+if __name__ == '__main__':
+    unittest.main()